@@ -0,0 +1,20 @@
+"""
+Gunicorn config for the inference server.
+Run from src/ml: gunicorn -c gunicorn.conf.py inference:app
+"""
+
+import os
+
+# Same defaults as python inference.py: 2 OMP threads per XGBoost call,
+# one worker per OMP thread group. inference.py reads both variables.
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+omp_threads = int(os.environ['OMP_NUM_THREADS'])
+os.environ.setdefault('WEB_CONCURRENCY', str(max(1, (os.cpu_count() or 1) // omp_threads)))
+
+bind = '0.0.0.0:8000'
+workers = int(os.environ['WEB_CONCURRENCY'])
+worker_class = 'uvicorn_worker.UvicornWorker'
+
+# Import the app (and load the model) once in the master; forked workers
+# share the loaded model pages copy-on-write
+preload_app = True
@@ -3,19 +3,45 @@ FastAPI Inference Server for Crypto Predictions
 Loads trained model and serves probability predictions.
 """
 
-from fastapi import FastAPI, HTTPException
+import os
+
+# Threads each XGBoost call may use. Must be set before xgboost is
+# imported (joblib.load imports it while unpickling the model).
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+N_OMP_THREADS = int(os.environ['OMP_NUM_THREADS'])
+# Uvicorn worker processes sharing this machine (uvicorn reads the same variable)
+N_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import asyncio
+import operator
+import re
+import msgspec
+import orjson
+import xxhash
 import numpy as np
 import joblib
 import json
 from pathlib import Path
 
+from model_utils import fitted_booster
+
+try:
+    import tl2cgen
+except ImportError:
+    tl2cgen = None
+
 app = FastAPI(
     title="Crypto Prediction API",
     description="ML-powered crypto price direction predictions",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS for frontend
@@ -27,16 +53,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load model on startup
+# Inference runs off the event loop, one OMP team per thread, with the
+# cores split evenly across worker processes
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, (os.cpu_count() or 1) // (N_OMP_THREADS * N_WORKERS))
+)
+
+# Recent predictions keyed by hash of the quantized feature row
+CACHE_DECIMALS = 3
+prediction_cache = TTLCache(maxsize=10_000, ttl=30)
+cache_hits = 0
+
+# Confidence buckets: [0, 0.55) low, [0.55, 0.7) medium, [0.7, 1] high
+CONFIDENCE_THRESHOLDS = np.array([0.55, 0.7])
+CONFIDENCE_LABELS = np.array(["low", "medium", "high"])
+
+# Model state, filled by load_model() when this module is imported as
+# inference:app (see the bottom of the file)
 MODEL_DIR = Path(__file__).parent
 model = None
 metadata = None
 feature_columns = []
+# Reads all feature_columns off a CoinFeatures as one tuple, in model order
+feature_getter = None
+booster = None
+# Isotonic calibration points, applied with np.interp
+iso_x = None
+iso_y = None
+# Treelite-compiled booster, used for single-row scoring
+compiled_predictor = None
 
 
-@app.on_event("startup")
-async def load_model():
-    global model, metadata, feature_columns
+def load_model():
+    """Load model, metadata and calibration points from MODEL_DIR"""
+    global model, metadata, feature_columns, feature_getter, booster, iso_x, iso_y, compiled_predictor
     
     model_path = MODEL_DIR / 'crypto_model.pkl'
     meta_path = MODEL_DIR / 'crypto_model_meta.json'
@@ -45,16 +95,71 @@ async def load_model():
         print("⚠️  No trained model found. Run train.py first.")
         return
     
-    model = joblib.load(model_path)
-    
     with open(meta_path, 'r') as f:
         metadata = json.load(f)
     
+    unknown = [c for c in metadata['features'] if c not in FEATURE_DEFAULTS]
+    if unknown:
+        print(f"⚠️  Model expects features missing from CoinFeatures: {unknown}")
+        return
+    
+    loaded = joblib.load(model_path)
+    if getattr(loaded, 'model_id_', None) != metadata.get('model_id'):
+        print("⚠️  Model and metadata come from different training runs. Re-run train.py.")
+        return
+    
+    model = loaded
+    calibrated = model.calibrated_classifiers_[0]
+    booster = fitted_booster(calibrated.estimator)
+    iso_x = calibrated.calibrators[0].X_thresholds_
+    iso_y = calibrated.calibrators[0].y_thresholds_
+    
     feature_columns = metadata['features']
+    feature_getter = operator.attrgetter(*feature_columns)
+    prediction_cache.clear()
+    
+    # The compiled library is optional (and gitignored); fall back to
+    # inplace_predict whenever it cannot be loaded
+    compiled_predictor = None
+    compiled_lib = metadata.get('compiled_lib')
+    if tl2cgen is not None and compiled_lib:
+        lib_path = MODEL_DIR / compiled_lib
+        if not lib_path.exists():
+            print(f"⚠️  Compiled booster {lib_path} not found, using inplace_predict")
+        else:
+            try:
+                compiled_predictor = tl2cgen.Predictor(str(lib_path), nthread=1)
+                print("✅ Loaded compiled booster")
+            except Exception as e:
+                print(f"⚠️  Could not load compiled booster ({e}), using inplace_predict")
+    
     print(f"✅ Loaded model v{metadata['version']} with {len(feature_columns)} features")
 
 
-class CoinFeatures(BaseModel):
+@app.on_event("startup")
+async def warm_up():
+    """
+    Pay XGBoost's first-call costs (OMP team, buffers) before serving traffic.
+    Runs in each worker after fork: OpenMP must not be started in a
+    preloading parent before it forks.
+    """
+    if model is None:
+        return
+    
+    warm = np.zeros((16, len(feature_columns)), dtype=np.float32)
+    _predict_proba(warm)
+    _predict_proba(warm[:1], compiled=True)
+    await asyncio.sleep(0)
+
+
+@app.on_event("shutdown")
+async def shutdown_executor():
+    EXECUTOR.shutdown(wait=False)
+
+
+# Request schemas are msgspec Structs, decoded from the raw body in one
+# C pass; response schemas stay pydantic and only document the API.
+class CoinFeatures(msgspec.Struct, frozen=True):
     """Input features for a single coin prediction"""
     coin_id: str
     rsi: float = 50.0
@@ -90,16 +195,93 @@ class PredictionResult(BaseModel):
     prediction: int  # 1 = up >1%, 0 = not
 
 
-class BatchPredictionRequest(BaseModel):
+class BatchPredictionRequest(msgspec.Struct):
     """Request for predicting multiple coins"""
     coins: List[CoinFeatures]
 
 
+class BatchPredictionRequestSoA(msgspec.Struct):
+    """Request for predicting multiple coins, one list per feature"""
+    coin_ids: List[str]
+    features: Dict[str, List[float]]  # feature name -> value per coin
+
+
 class BatchPredictionResponse(BaseModel):
     """Response with all predictions"""
     predictions: List[PredictionResult]
     model_version: str
+
+
+# Defaults used for feature columns missing from a column-oriented request
+FEATURE_DEFAULTS = {f.name: f.default for f in msgspec.structs.fields(CoinFeatures)}
+
+
+# Routes read the raw body, so FastAPI can't infer request schemas; publish
+# the msgspec ones instead (refs per route, definitions under components)
+(
+    COIN_FEATURES_SCHEMA, BATCH_REQUEST_SCHEMA, BATCH_REQUEST_SOA_SCHEMA
+), REQUEST_COMPONENTS = msgspec.json.schema_components(
+    [CoinFeatures, BatchPredictionRequest, BatchPredictionRequestSoA],
+    ref_template="#/components/schemas/{name}"
+)
+
+
+def _request_body(schema: dict) -> dict:
+    """openapi_extra describing a required JSON request body"""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": schema}}
+        }
+    }
+
+
+def _openapi():
+    """Default OpenAPI schema plus the msgspec request components"""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(REQUEST_COMPONENTS)
+    return app.openapi_schema
+
+
+app.openapi = _openapi
+
+
+# msgspec reports one error as "<message> - at `$.coins[0].rsi`"
+_ERROR_LOCATION = re.compile(r"^(?P<msg>.*?)(?: - at `\$(?P<path>.*)`)?$", re.DOTALL)
+_PATH_PART = re.compile(r"\.([^.\[]+)|\[(\d+)\]|\[(\.\.\.)\]")
+_MISSING_FIELD = re.compile(r"^Object missing required field `(?P<field>.+)`$")
+
+
+def _validation_error(e: msgspec.DecodeError) -> dict:
+    """Translate a msgspec error into one FastAPI-style validation error entry"""
+    if not isinstance(e, msgspec.ValidationError):
+        return {"type": "json_invalid", "loc": ["body"], "msg": str(e)}
     
+    match = _ERROR_LOCATION.match(str(e))
+    msg = match.group('msg')
+    loc = ["body"]
+    for part in _PATH_PART.finditer(match.group('path') or ''):
+        key, index, dict_key = part.groups()
+        loc.append(key if key is not None else int(index) if index is not None else dict_key)
+    
+    missing = _MISSING_FIELD.match(msg)
+    if missing:
+        return {"type": "missing", "loc": loc + [missing.group('field')], "msg": msg}
+    return {"type": "value_error", "loc": loc, "msg": msg}
+
+
+async def _decode(request: Request, schema: type):
+    """
+    Decode and validate a JSON request body into a msgspec Struct.
+    Failures raise a 422 in FastAPI's usual {"detail": [{loc, msg, type}]}
+    shape; msgspec stops at the first error, so detail has one entry.
+    """
+    try:
+        return msgspec.json.decode(await request.body(), type=schema, strict=False)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=[_validation_error(e)])
+
 
 @app.get("/health")
 async def health_check():
@@ -107,104 +289,224 @@ async def health_check():
     return {
         "status": "healthy" if model is not None else "no_model",
         "model_version": metadata.get('version') if metadata else None,
-        "features_count": len(feature_columns)
+        "features_count": len(feature_columns),
+        "cache_hits": cache_hits,
+        "cache_size": len(prediction_cache)
     }
 
 
-@app.post("/predict", response_model=PredictionResult)
-async def predict_single(coin: CoinFeatures):
+# Routes skip response_model validation and return plain dicts;
+# the schema is still published for the docs via responses=
+@app.post(
+    "/predict",
+    responses={200: {"model": PredictionResult}},
+    openapi_extra=_request_body(COIN_FEATURES_SCHEMA)
+)
+async def predict_single(request: Request):
     """Predict probability for a single coin"""
+    coin = await _decode(request, CoinFeatures)
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded. Run train.py first.")
     
     # Convert to feature array
-    features = _extract_features(coin)
+    X = _feature_matrix([coin])
     
     # Get probability
-    prob = model.predict_proba([features])[0][1]
-    prediction = int(prob >= 0.5)
-    
-    # Determine confidence level
-    if prob >= 0.7:
-        confidence = "high"
-    elif prob >= 0.55:
-        confidence = "medium"
-    else:
-        confidence = "low"
+    probs = await _score_cached(X, compiled=True)
+    preds, confidences = _label(probs)
     
-    return PredictionResult(
-        coin_id=coin.coin_id,
-        probability=round(prob, 4),
-        confidence=confidence,
-        prediction=prediction
-    )
+    return {
+        "coin_id": coin.coin_id,
+        "probability": round(float(probs[0]), 4),
+        "confidence": str(confidences[0]),
+        "prediction": int(preds[0])
+    }
 
 
-@app.post("/predict/batch", response_model=BatchPredictionResponse)
-async def predict_batch(request: BatchPredictionRequest):
+@app.post(
+    "/predict/batch",
+    responses={200: {"model": BatchPredictionResponse}},
+    openapi_extra=_request_body(BATCH_REQUEST_SCHEMA)
+)
+async def predict_batch(request: Request):
     """Predict probabilities for multiple coins"""
+    payload = await _decode(request, BatchPredictionRequest)
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded. Run train.py first.")
     
-    predictions = []
-    
-    for coin in request.coins:
-        features = _extract_features(coin)
-        prob = model.predict_proba([features])[0][1]
-        prediction = int(prob >= 0.5)
-        
-        if prob >= 0.7:
-            confidence = "high"
-        elif prob >= 0.55:
-            confidence = "medium"
-        else:
-            confidence = "low"
-        
-        predictions.append(PredictionResult(
-            coin_id=coin.coin_id,
-            probability=round(prob, 4),
-            confidence=confidence,
-            prediction=prediction
-        ))
+    # Stack all coins into one (N, F) matrix and score in a single call
+    X = _feature_matrix(payload.coins)
     
-    # Sort by probability descending
-    predictions.sort(key=lambda x: x.probability, reverse=True)
+    probs = await _score_cached(X)
+    return _batch_response([coin.coin_id for coin in payload.coins], probs)
+
+
+@app.post("/predict/batch/stream", openapi_extra=_request_body(BATCH_REQUEST_SCHEMA))
+async def predict_batch_stream(request: Request):
+    """
+    Predict probabilities for multiple coins, streamed as NDJSON.
+    One PredictionResult object per line, in request order; the model
+    version is sent in the X-Model-Version header.
+    """
+    payload = await _decode(request, BatchPredictionRequest)
+    if model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Run train.py first.")
+    
+    X = _feature_matrix(payload.coins)
     
-    return BatchPredictionResponse(
-        predictions=predictions,
-        model_version=metadata.get('version', 'unknown')
+    probs = await _score_cached(X)
+    preds, confidences = _label(probs)
+    
+    def generate_ndjson():
+        for coin, prob, confidence, pred in zip(
+            payload.coins, np.round(probs, 4).tolist(), confidences.tolist(), preds.tolist()
+        ):
+            yield orjson.dumps({
+                "coin_id": coin.coin_id,
+                "probability": prob,
+                "confidence": confidence,
+                "prediction": pred
+            }) + b"\n"
+    
+    return StreamingResponse(
+        generate_ndjson(),
+        media_type="application/x-ndjson",
+        headers={"X-Model-Version": metadata.get('version', 'unknown')}
     )
 
 
-def _extract_features(coin: CoinFeatures) -> list:
-    """Extract feature array in correct order for model"""
-    return [
-        coin.rsi,
-        coin.macd,
-        coin.macd_signal,
-        coin.macd_histogram,
-        coin.ema_20,
-        coin.ema_50,
-        coin.atr,
-        coin.atr_percent,
-        coin.bb_position,
-        coin.volume_ratio,
-        coin.price_vs_ema20,
-        coin.price_vs_ema50,
-        coin.ema20_trend,
-        coin.ema50_trend,
-        coin.price_above_ema20,
-        coin.price_above_ema50,
-        coin.ema20_above_ema50,
-        coin.momentum_24h,
-        coin.momentum_7d,
-        coin.market_cap_tier,
-        coin.volatility_tier,
-        coin.btc_correlation,
-        coin.market_regime
+@app.post(
+    "/predict/batch/columns",
+    responses={200: {"model": BatchPredictionResponse}},
+    openapi_extra=_request_body(BATCH_REQUEST_SOA_SCHEMA)
+)
+async def predict_batch_columns(request: Request):
+    """Predict probabilities for multiple coins sent as feature columns"""
+    payload = await _decode(request, BatchPredictionRequestSoA)
+    if model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Run train.py first.")
+    
+    n = len(payload.coin_ids)
+    columns = []
+    for name in feature_columns:
+        values = payload.features.get(name)
+        if values is None:
+            # Missing columns fall back to the same defaults as CoinFeatures
+            columns.append(np.full(n, FEATURE_DEFAULTS[name], dtype=np.float32))
+        elif len(values) != n:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Feature '{name}' has {len(values)} values, expected {n}"
+            )
+        else:
+            columns.append(np.asarray(values, dtype=np.float32))
+    
+    X = np.stack(columns, axis=1)
+    probs = await _score_cached(X)
+    return _batch_response(payload.coin_ids, probs)
+
+
+def _batch_response(coin_ids: List[str], probs: np.ndarray) -> dict:
+    """Build the batch response, sorted by probability descending"""
+    # Sort by probability descending
+    order = np.argsort(-probs, kind='stable')
+    probs = probs[order]
+    coin_ids = [coin_ids[i] for i in order]
+    preds, confidences = _label(probs)
+    
+    predictions = [
+        {
+            "coin_id": coin_id,
+            "probability": prob,
+            "confidence": confidence,
+            "prediction": pred
+        }
+        for coin_id, prob, confidence, pred in zip(
+            coin_ids, np.round(probs, 4).tolist(), confidences.tolist(), preds.tolist()
+        )
     ]
+    
+    return {
+        "predictions": predictions,
+        "model_version": metadata.get('version', 'unknown')
+    }
+
+
+def _label(probs: np.ndarray):
+    """Predicted class (up >1% at p >= 0.5) and confidence bucket per probability"""
+    preds = (probs >= 0.5).view(np.int8)
+    confidences = CONFIDENCE_LABELS[np.digitize(probs, CONFIDENCE_THRESHOLDS)]
+    return preds, confidences
+
+
+async def _score_cached(X: np.ndarray, compiled: bool = False) -> np.ndarray:
+    """Calibrated P(up) per row, scoring only rows missing from the cache"""
+    global cache_hits
+    
+    # Adding 0.0 folds -0.0 into 0.0 so both hash the same
+    quantized = np.round(X, CACHE_DECIMALS) + 0.0
+    keys = [xxhash.xxh64_intdigest(row.tobytes()) for row in quantized]
+    
+    probs = np.empty(len(X))
+    misses = []
+    for i, key in enumerate(keys):
+        cached = prediction_cache.get(key)
+        if cached is None:
+            misses.append(i)
+        else:
+            probs[i] = cached
+    cache_hits += len(X) - len(misses)
+    
+    if misses:
+        scored = await asyncio.get_running_loop().run_in_executor(
+            EXECUTOR, _predict_proba, X[misses], compiled
+        )
+        probs[misses] = scored
+        for i, prob in zip(misses, scored):
+            prediction_cache[keys[i]] = float(prob)
+    
+    return probs
+
+
+def _predict_proba(X: np.ndarray, compiled: bool = False) -> np.ndarray:
+    """
+    Calibrated P(up) for each row of X.
+    Equivalent to model.predict_proba(X)[:, 1]: one booster pass over a
+    contiguous float32 buffer via inplace_predict, then the isotonic step
+    as a clipped linear interpolation (same as IsotonicRegression.predict).
+    With compiled=True the Treelite library is used when available, which
+    is faster for single rows.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if compiled and compiled_predictor is not None:
+        raw = compiled_predictor.predict(tl2cgen.DMatrix(X)).reshape(-1)
+    else:
+        raw = booster.inplace_predict(X)
+    return np.interp(raw, iso_x, iso_y)
+
+
+def _feature_matrix(coins: List[CoinFeatures]) -> np.ndarray:
+    """Stack coin features into an (N, F) float32 matrix in model order"""
+    X = np.empty((len(coins), len(feature_columns)), dtype=np.float32)
+    for i, coin in enumerate(coins):
+        _extract_features(coin, X, i)
+    return X
+
+
+def _extract_features(coin: CoinFeatures, out: np.ndarray, i: int) -> None:
+    """Write coin features into row i of out, in correct order for model"""
+    out[i] = feature_getter(coin)
 
 
 if __name__ == '__main__':
+    # Workers import inference:app themselves and load the model there
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    workers = max(1, (os.cpu_count() or 1) // N_OMP_THREADS)
+    # Worker processes inherit this and size their executors from it
+    os.environ['WEB_CONCURRENCY'] = str(workers)
+    print(f"Starting {workers} workers x {N_OMP_THREADS} OMP threads")
+    uvicorn.run("inference:app", host="0.0.0.0", port=8000, workers=workers, app_dir=str(MODEL_DIR))
+else:
+    # Load at import, so a preloading server (gunicorn -c gunicorn.conf.py)
+    # reads the model once before forking and workers share it copy-on-write
+    load_model()
@@ -0,0 +1,10 @@
+"""
+Helpers shared by the training script and the inference server.
+"""
+
+
+def fitted_booster(estimator):
+    """Booster trimmed to the early-stopping best iteration"""
+    booster = estimator.get_booster()
+    best = getattr(estimator, 'best_iteration', None)
+    return booster[:best + 1] if best is not None else booster
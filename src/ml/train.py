@@ -6,16 +6,24 @@ Outputs calibrated probability model.
 
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import TimeSeriesSplit
 from sklearn.calibration import CalibratedClassifierCV
 from sklearn.metrics import classification_report, brier_score_loss
 from xgboost import XGBClassifier
 import joblib
 import json
+import os
+import uuid
 from pathlib import Path
 import sqlite3
 from datetime import datetime, timedelta
 
+from model_utils import fitted_booster
+
+try:
+    from sklearn.frozen import FrozenEstimator
+except ImportError:  # scikit-learn < 1.6
+    FrozenEstimator = None
+
 # Paths
 BASE_DIR = Path(__file__).parent.parent.parent
 DATA_DIR = BASE_DIR / 'data'
@@ -60,62 +68,68 @@ class CryptoModelTrainer:
         Generate realistic synthetic training data for initial model.
         In production, replace with actual historical data.
         """
-        np.random.seed(42)
+        rng = np.random.default_rng(42)
         
         data = {
-            'rsi': np.random.uniform(20, 80, n_samples),
-            'macd': np.random.uniform(-0.5, 0.5, n_samples),
-            'macd_signal': np.random.uniform(-0.3, 0.3, n_samples),
-            'volume_ratio': np.random.uniform(0.5, 3.0, n_samples),
-            'atr_percent': np.random.uniform(1, 10, n_samples),
-            'bb_position': np.random.uniform(0, 1, n_samples),
-            'price_vs_ema20': np.random.uniform(-5, 5, n_samples),
-            'price_vs_ema50': np.random.uniform(-10, 10, n_samples),
-            'momentum_24h': np.random.uniform(-10, 10, n_samples),
-            'momentum_7d': np.random.uniform(-20, 20, n_samples),
-            'market_cap_tier': np.random.choice([0, 1, 2], n_samples),  # small, mid, large
-            'volatility_tier': np.random.choice([0, 1, 2], n_samples),
-            'btc_correlation': np.random.uniform(0.3, 0.9, n_samples),
-            'market_regime': np.random.choice([0, 1, 2], n_samples),  # risk_off, neutral, risk_on
+            'rsi': rng.uniform(20, 80, n_samples),
+            'macd': rng.uniform(-0.5, 0.5, n_samples),
+            'macd_signal': rng.uniform(-0.3, 0.3, n_samples),
+            'volume_ratio': rng.uniform(0.5, 3.0, n_samples),
+            'atr_percent': rng.uniform(1, 10, n_samples),
+            'bb_position': rng.uniform(0, 1, n_samples),
+            'price_vs_ema20': rng.uniform(-5, 5, n_samples),
+            'price_vs_ema50': rng.uniform(-10, 10, n_samples),
+            'momentum_24h': rng.uniform(-10, 10, n_samples),
+            'momentum_7d': rng.uniform(-20, 20, n_samples),
+            'market_cap_tier': rng.integers(0, 3, n_samples),  # small, mid, large
+            'volatility_tier': rng.integers(0, 3, n_samples),
+            'btc_correlation': rng.uniform(0.3, 0.9, n_samples),
+            'market_regime': rng.integers(0, 3, n_samples),  # risk_off, neutral, risk_on
         }
         
         # Derived features
-        data['macd_histogram'] = np.array(data['macd']) - np.array(data['macd_signal'])
-        data['ema_20'] = np.random.uniform(100, 10000, n_samples)
-        data['ema_50'] = data['ema_20'] * np.random.uniform(0.9, 1.1, n_samples)
+        data['macd_histogram'] = data['macd'] - data['macd_signal']
+        data['ema_20'] = rng.uniform(100, 10000, n_samples)
+        data['ema_50'] = data['ema_20'] * rng.uniform(0.9, 1.1, n_samples)
         data['atr'] = data['ema_20'] * data['atr_percent'] / 100
-        data['ema20_trend'] = np.random.choice([0, 1, 2], n_samples)  # down, neutral, up
-        data['ema50_trend'] = np.random.choice([0, 1, 2], n_samples)
-        data['price_above_ema20'] = (np.array(data['price_vs_ema20']) > 0).astype(int)
-        data['price_above_ema50'] = (np.array(data['price_vs_ema50']) > 0).astype(int)
-        data['ema20_above_ema50'] = (np.array(data['ema_20']) > np.array(data['ema_50'])).astype(int)
-        
-        df = pd.DataFrame(data)
+        data['ema20_trend'] = rng.integers(0, 3, n_samples)  # down, neutral, up
+        data['ema50_trend'] = rng.integers(0, 3, n_samples)
+        data['price_above_ema20'] = (data['price_vs_ema20'] > 0).astype(int)
+        data['price_above_ema50'] = (data['price_vs_ema50'] > 0).astype(int)
+        data['ema20_above_ema50'] = (data['ema_20'] > data['ema_50']).astype(int)
         
         # Generate realistic target based on pattern logic
         # Bullish conditions increase probability of >1% return
+        rsi = data['rsi']
+        volume_ratio = data['volume_ratio']
+        bb_position = data['bb_position']
+        market_regime = data['market_regime']
+        
         prob = 0.5  # base probability
         scores = (
-            (df['rsi'].between(50, 70)).astype(float) * 0.1 +
-            (df['rsi'] < 30).astype(float) * 0.05 +  # oversold bounce
-            (df['rsi'] > 80).astype(float) * -0.15 +  # overbought reversal
-            (df['macd_histogram'] > 0).astype(float) * 0.08 +
-            (df['volume_ratio'] > 1.5).astype(float) * 0.12 +
-            (df['volume_ratio'] > 2.0).astype(float) * 0.05 +
-            (df['price_above_ema20'] == 1).astype(float) * 0.1 +
-            (df['ema20_trend'] == 2).astype(float) * 0.08 +  # up trend
-            (df['momentum_24h'] > 2).astype(float) * 0.06 +
-            (df['bb_position'].between(0.3, 0.7)).astype(float) * 0.05 +
-            (df['market_regime'] == 2).astype(float) * 0.08 -  # risk_on
-            (df['market_regime'] == 0).astype(float) * 0.1  # risk_off
+            ((rsi >= 50) & (rsi <= 70)) * 0.1 +
+            (rsi < 30) * 0.05 +  # oversold bounce
+            (rsi > 80) * -0.15 +  # overbought reversal
+            (data['macd_histogram'] > 0) * 0.08 +
+            (volume_ratio > 1.5) * 0.12 +
+            (volume_ratio > 2.0) * 0.05 +
+            (data['price_above_ema20'] == 1) * 0.1 +
+            (data['ema20_trend'] == 2) * 0.08 +  # up trend
+            (data['momentum_24h'] > 2) * 0.06 +
+            ((bb_position >= 0.3) & (bb_position <= 0.7)) * 0.05 +
+            (market_regime == 2) * 0.08 -  # risk_on
+            (market_regime == 0) * 0.1  # risk_off
         )
         
         final_prob = np.clip(prob + scores, 0.1, 0.9)
-        df['target'] = (np.random.random(n_samples) < final_prob).astype(int)
+        target = (rng.random(n_samples) < final_prob).astype(np.int8)
         
         # Add some noise
-        noise_idx = np.random.choice(n_samples, int(n_samples * 0.1), replace=False)
-        df.loc[noise_idx, 'target'] = 1 - df.loc[noise_idx, 'target']
+        noise_idx = rng.choice(n_samples, int(n_samples * 0.1), replace=False)
+        target[noise_idx] ^= 1
+        data['target'] = target
+        
+        df = pd.DataFrame(data)
         
         print(f"Generated {len(df)} samples, positive rate: {df['target'].mean():.2%}")
         return df
@@ -123,39 +137,59 @@ class CryptoModelTrainer:
     def prepare_features(self, df):
         """Prepare feature matrix for training"""
         feature_cols = [col for col in self.feature_columns if col in df.columns]
-        X = df[feature_cols].fillna(0)
+        # float32 matches what the inference server feeds the boosters
+        X = df[feature_cols].fillna(0).astype(np.float32)
         y = df['target'] if 'target' in df.columns else None
         return X, y, feature_cols
     
     def train(self, df):
-        """Train XGBoost model with time-series cross-validation"""
+        """Train XGBoost model once, then calibrate on a held-out time slice"""
         X, y, feature_cols = self.prepare_features(df)
         
-        print(f"Training on {len(X)} samples with {len(feature_cols)} features...")
+        # Chronological split: fit on the first 70%, early-stop on the next
+        # 10%, calibrate on the last 20% (untouched by fitting or stopping)
+        stop_split = int(len(X) * 0.7)
+        cal_split = int(len(X) * 0.8)
+        X_fit, y_fit = X.iloc[:stop_split], y.iloc[:stop_split]
+        X_stop, y_stop = X.iloc[stop_split:cal_split], y.iloc[stop_split:cal_split]
+        X_cal, y_cal = X.iloc[cal_split:], y.iloc[cal_split:]
+        
+        print(f"Training on {len(X_fit)} samples with {len(feature_cols)} features, "
+              f"early stopping on {len(X_stop)}, calibrating on {len(X_cal)}...")
         
         # XGBoost base model
         self.model = XGBClassifier(
-            n_estimators=100,
+            tree_method='hist',
+            max_bin=256,
+            n_estimators=500,
+            early_stopping_rounds=20,
             max_depth=6,
             learning_rate=0.1,
             min_child_weight=3,
             subsample=0.8,
             colsample_bytree=0.8,
             random_state=42,
-            eval_metric='logloss'
+            eval_metric='logloss',
+            n_jobs=-1
         )
+        self.model.fit(X_fit, y_fit, eval_set=[(X_stop, y_stop)], verbose=False)
+        print(f"Early stopping at {self.model.best_iteration + 1} trees")
         
-        # Time-series cross-validation
-        tscv = TimeSeriesSplit(n_splits=5)
-        
-        # Calibrated model with isotonic regression
-        self.calibrated_model = CalibratedClassifierCV(
-            self.model,
-            method='isotonic',
-            cv=tscv
-        )
+        # Calibrated model with isotonic regression on the already-fitted booster
+        if FrozenEstimator is not None:
+            self.calibrated_model = CalibratedClassifierCV(
+                FrozenEstimator(self.model),
+                method='isotonic',
+                ensemble=False
+            )
+        else:
+            self.calibrated_model = CalibratedClassifierCV(
+                self.model,
+                method='isotonic',
+                cv='prefit'
+            )
         
-        self.calibrated_model.fit(X, y)
+        self.calibrated_model.fit(X_cal, y_cal)
         
         # Evaluate
         y_pred = self.calibrated_model.predict(X)
@@ -166,7 +200,6 @@ class CryptoModelTrainer:
         print(f"Brier Score: {brier_score_loss(y, y_prob):.4f}")
         
         # Feature importance from base model
-        self.model.fit(X, y)
         importance = pd.DataFrame({
             'feature': feature_cols,
             'importance': self.model.feature_importances_
@@ -178,30 +211,79 @@ class CryptoModelTrainer:
         return self.calibrated_model
     
     def save_model(self, name='crypto_model'):
-        """Save trained model and metadata"""
+        """
+        Save trained model and metadata.
+        Both files (and the compiled library name) carry the same model_id
+        so the inference server can refuse a pkl/metadata pair from
+        different runs; each file is written to a temp path and renamed
+        into place so a crash never leaves a half-written file.
+        """
         if self.calibrated_model is None:
             raise ValueError("No trained model to save")
         
+        model_id = uuid.uuid4().hex
+        self.calibrated_model.model_id_ = model_id
+        
+        # Compile booster to native code for low-latency single-row scoring
+        compiled_lib = self._compile_booster(f'{name}_{model_id}')
+        
         # Save model
         model_path = MODEL_DIR / f'{name}.pkl'
-        joblib.dump(self.calibrated_model, model_path)
+        tmp_path = model_path.with_suffix('.pkl.tmp')
+        joblib.dump(self.calibrated_model, tmp_path, compress=3)
+        os.replace(tmp_path, model_path)
         print(f"Saved model to {model_path}")
         
         # Save metadata
         metadata = {
             'version': '1.0',
+            'model_id': model_id,
             'trained_at': datetime.now().isoformat(),
             'features': self.feature_columns,
-            'target': 'price_up_1pct_24h'
+            'target': 'price_up_1pct_24h',
+            'compiled_lib': compiled_lib
         }
         
         meta_path = MODEL_DIR / f'{name}_meta.json'
-        with open(meta_path, 'w') as f:
+        tmp_path = meta_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
             json.dump(metadata, f, indent=2)
+        os.replace(tmp_path, meta_path)
         print(f"Saved metadata to {meta_path}")
         
+        # Drop libraries compiled for earlier runs
+        for lib_path in MODEL_DIR.glob(f'{name}_*.so'):
+            if lib_path.name != compiled_lib:
+                lib_path.unlink()
+        
         return model_path, meta_path
     
+    def _compile_booster(self, name):
+        """Compile the booster to a shared library with Treelite"""
+        try:
+            import treelite
+            import tl2cgen
+        except ImportError:
+            print("⚠️  treelite/tl2cgen not installed, skipping compiled model")
+            return None
+        
+        estimator = self.calibrated_model.calibrated_classifiers_[0].estimator
+        lib_path = MODEL_DIR / f'{name}.so'
+        try:
+            tl_model = treelite.frontend.from_xgboost(fitted_booster(estimator))
+            tl2cgen.export_lib(
+                tl_model,
+                toolchain='gcc',
+                libpath=str(lib_path),
+                params={'parallel_comp': 0}
+            )
+        except Exception as e:  # e.g. no gcc, or a booster format Treelite can't read
+            print(f"⚠️  Could not compile booster ({e}), skipping compiled model")
+            return None
+        
+        print(f"Compiled booster to {lib_path}")
+        return lib_path.name
+    
     def load_model(self, name='crypto_model'):
         """Load trained model"""
         model_path = MODEL_DIR / f'{name}.pkl'